@@ -1,17 +1,24 @@
 #!/bin/python3
 import argparse
+import hashlib
 import os
 import stat
-import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
 import host
 import osd
 from util import (
+    SSH_PARALLELISM,
     Config,
+    SeedShell,
     Target,
+    docker_compose,
+    docker_compose_supports,
     ensure_inside_container,
     ensure_outside_container,
     get_boxes_container_info,
+    invalidate_boxes_container_info,
     run_cephadm_shell_command,
     run_dc_shell_command,
     run_shell_command,
@@ -22,13 +29,30 @@ BOX_IMAGE = 'cephadm-box:latest'
 
 # NOTE: this image tar is a trickeroo so cephadm won't pull the image everytime
 # we deploy a cluster. Keep in mind that you'll be responsible of pulling the
-# image yourself with `box cluster setup`
-CEPH_IMAGE_TAR = 'docker/ceph/image/quay.ceph.image.tar'
+# image yourself with `box cluster setup`. The tar is compressed with a fast
+# gzip level to write less to the bind mount, docker load reads it as is.
+CEPH_IMAGE_TAR = 'docker/ceph/image/quay.ceph.image.tar.gz'
+# id of the image stored in CEPH_IMAGE_TAR, used to skip saving it again
+CEPH_IMAGE_TAR_ID = f'{CEPH_IMAGE_TAR}.id'
+# the tar and its id are written here first and then renamed into place
+CEPH_IMAGE_TAR_TMP = f'{CEPH_IMAGE_TAR}.tmp'
+CEPH_IMAGE_TAR_ID_TMP = f'{CEPH_IMAGE_TAR_ID}.tmp'
+# uncompressed tar written by older versions of box
+LEGACY_CEPH_IMAGE_TAR = 'docker/ceph/image/quay.ceph.image.tar'
+# hash of the box image build files, used to skip rebuilding it
+BOX_BUILD_STAMP = '.box-build.stamp'
 
 
 def remove_ceph_image_tar():
-    if os.path.exists(CEPH_IMAGE_TAR):
-        os.remove(CEPH_IMAGE_TAR)
+    for path in (
+        CEPH_IMAGE_TAR,
+        CEPH_IMAGE_TAR_ID,
+        CEPH_IMAGE_TAR_TMP,
+        CEPH_IMAGE_TAR_ID_TMP,
+        LEGACY_CEPH_IMAGE_TAR,
+    ):
+        if os.path.exists(path):
+            os.remove(path)
 
 
 def cleanup_box() -> None:
@@ -37,19 +61,24 @@ def cleanup_box() -> None:
 
 
 def image_exists(image_name: str):
-    # extract_tag
-    assert image_name.find(':')
-    image_name, tag = image_name.split(':')
-    images = run_shell_command('docker image ls').split('\n')
-    IMAGE_NAME = 0
-    TAG = 1
-    for image in images:
-        image = image.split()
-        print(image)
-        print(image_name, tag)
-        if image[IMAGE_NAME] == image_name and image[TAG] == tag:
-            return True
-    return False
+    # let docker filter the images instead of listing all of them
+    out = run_shell_command(
+        f"docker images --filter=reference={image_name} --format '{{{{.ID}}}}'"
+    )
+    return bool(out)
+
+
+def _ceph_image_tar_is_current(image_id: str) -> bool:
+    if not os.path.exists(CEPH_IMAGE_TAR) or not os.path.exists(CEPH_IMAGE_TAR_ID):
+        return False
+    with open(CEPH_IMAGE_TAR_ID) as f:
+        return f.read().strip() == image_id
+
+
+def _write_ceph_image_tar_id(image_id: str) -> None:
+    with open(CEPH_IMAGE_TAR_ID_TMP, 'w') as f:
+        f.write(image_id)
+    os.replace(CEPH_IMAGE_TAR_ID_TMP, CEPH_IMAGE_TAR_ID)
 
 
 def get_ceph_image():
@@ -60,15 +89,52 @@ def get_ceph_image():
     if not os.path.exists('docker/ceph/image'):
         os.mkdir('docker/ceph/image')
 
-    remove_ceph_image_tar()
-
-    run_shell_command(f'docker save {CEPH_IMAGE} -o {CEPH_IMAGE_TAR}')
+    image_id = run_shell_command(f"docker image inspect --format '{{{{.Id}}}}' {CEPH_IMAGE}")
+    if _ceph_image_tar_is_current(image_id):
+        print('Ceph image tar is up to date')
+    else:
+        # save next to the tar and swap it in, a failed save keeps the old tar
+        try:
+            run_shell_command(
+                f"bash -o pipefail -c 'docker save {CEPH_IMAGE} | gzip -1 > {CEPH_IMAGE_TAR_TMP}'"
+            )
+            os.replace(CEPH_IMAGE_TAR_TMP, CEPH_IMAGE_TAR)
+            _write_ceph_image_tar_id(image_id)
+        finally:
+            # only left behind if the save or a rename failed
+            for path in (CEPH_IMAGE_TAR_TMP, CEPH_IMAGE_TAR_ID_TMP):
+                if os.path.exists(path):
+                    os.remove(path)
     print('Ceph image added')
 
 
+def _build_files_hash(paths: List[str]) -> str:
+    """
+    Hash of the contents of the files a docker build reads
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(path.encode())
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
 def get_box_image():
     print('Getting box image')
+    # the Dockerfile doesn't COPY or ADD anything, the rest of the box directory
+    # is bind mounted into the boxes and doesn't change the image
+    context_hash = _build_files_hash(['Dockerfile', '.dockerignore'])
+    if os.path.exists(BOX_BUILD_STAMP) and image_exists(BOX_IMAGE):
+        with open(BOX_BUILD_STAMP) as f:
+            if f.read().strip() == context_hash:
+                print('Box image is up to date')
+                return
+
     run_shell_command('docker build -t cephadm-box -f Dockerfile .')
+    with open(BOX_BUILD_STAMP, 'w') as f:
+        f.write(context_hash)
     print('Box image added')
 
 
@@ -88,11 +154,35 @@ class Cluster(Target):
         self.parser.add_argument('--skip-monitoring-stack', action='store_true', help='skip monitoring stack')
         self.parser.add_argument('--skip-dashboard', action='store_true', help='skip dashboard')
         self.parser.add_argument('--expanded', action='store_true', help='deploy 3 hosts and 3 osds')
+        self.parser.add_argument(
+            '--ssh-parallelism',
+            type=int,
+            default=SSH_PARALLELISM,
+            help='max number of hosts to set up ssh on concurrently',
+        )
+        self.parser.add_argument(
+            '--serial-images',
+            action='store_true',
+            help='get the ceph and box images one after another on setup',
+        )
+        self.parser.add_argument(
+            '--compose-parallelism',
+            type=int,
+            default=os.cpu_count(),
+            help='max parallelism of docker compose when starting boxes, if supported',
+        )
 
     @ensure_outside_container
     def setup(self):
-        get_ceph_image()
-        get_box_image()
+        if Config.get('serial_images'):
+            get_ceph_image()
+            get_box_image()
+            return
+        # both images are independent, pull/build them at the same time
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(get_ceph_image), executor.submit(get_box_image)]
+            for future in futures:
+                future.result()
 
     @ensure_outside_container
     def cleanup(self):
@@ -103,31 +193,27 @@ class Cluster(Target):
         print('Running bootstrap on seed')
         cephadm_path = os.environ.get('CEPHADM_PATH')
         os.symlink('/cephadm/cephadm', cephadm_path)
-        run_shell_command(
-            'systemctl restart docker'
-        )  # restart to ensure docker is using daemon.json
-
         st = os.stat(cephadm_path)
         os.chmod(cephadm_path, st.st_mode | stat.S_IEXEC)
 
-        run_shell_command('docker load < /cephadm/box/docker/ceph/image/quay.ceph.image.tar')
         # cephadm guid error because it sometimes tries to use quay.ceph.io/ceph-ci/ceph:<none>
         # instead of main branch's tag
-        run_shell_command('export CEPH_SOURCE_FOLDER=/ceph')
-        run_shell_command('export CEPHADM_IMAGE=quay.ceph.io/ceph-ci/ceph:main')
+        os.environ['CEPH_SOURCE_FOLDER'] = '/ceph'
+        os.environ['CEPHADM_IMAGE'] = CEPH_IMAGE
+
+        # batch the setup commands so they share a single shell
         run_shell_command(
-            'echo "export CEPHADM_IMAGE=quay.ceph.io/ceph-ci/ceph:main" >> ~/.bashrc'
+            'set -e; '
+            # restart to ensure docker is using daemon.json
+            'systemctl restart docker; '
+            # skip loading if the seed's daemon already has the image (shared image store)
+            f'if ! docker image inspect {CEPH_IMAGE} > /dev/null 2>&1; then '
+            f'docker load < /cephadm/box/{CEPH_IMAGE_TAR}; '
+            'fi'
         )
+        with open(os.path.expanduser('~/.bashrc'), 'a') as f:
+            f.write(f'export CEPHADM_IMAGE={CEPH_IMAGE}\n')
 
-        extra_args = []
-
-        extra_args.append('--skip-pull')
-
-        # cephadm prints in warning, let's redirect it to the output so shell_command doesn't
-        # complain
-        extra_args.append('2>&0')
-
-        extra_args = ' '.join(extra_args)
         skip_monitoring_stack = (
             '--skip-monitoring-stack' if Config.get('skip-monitoring-stack') else ''
         )
@@ -155,16 +241,18 @@ class Cluster(Target):
             '--log-to-file '
             f'{skip_dashboard} '
             f'{skip_monitoring_stack} '
-            f'{extra_args} '
+            '--skip-pull '
         )
 
         print('Running cephadm bootstrap...')
-        run_shell_command(cephadm_bootstrap_command)
+        # cephadm prints in warning, let's redirect it to the output so shell_command doesn't
+        # complain
+        run_shell_command(cephadm_bootstrap_command, merge_stderr=True)
         print('Cephadm bootstrap complete')
 
-        run_shell_command('sudo vgchange --refresh')
-        run_shell_command('cephadm ls')
-        run_shell_command('ln -s /ceph/src/cephadm/box/box.py /usr/bin/box')
+        run_shell_command('set -e; sudo vgchange --refresh; cephadm ls')
+        if not os.path.lexists('/usr/bin/box'):
+            os.symlink('/ceph/src/cephadm/box/box.py', '/usr/bin/box')
 
         # NOTE: sometimes cephadm in the box takes a while to update the containers
         # running in the cluster and it cannot deploy the osds. In this case
@@ -178,7 +266,8 @@ class Cluster(Target):
         hosts = Config.get('hosts')
 
         # ensure boxes don't exist
-        run_shell_command('docker-compose down')
+        run_shell_command(f'{docker_compose()} down')
+        invalidate_boxes_container_info()
 
         print('Checking docker images')
         if not image_exists(CEPH_IMAGE):
@@ -196,14 +285,21 @@ class Cluster(Target):
         dcflags = '-f docker-compose.yml'
         if not os.path.exists('/sys/fs/cgroup/cgroup.controllers'):
             dcflags += ' -f docker-compose.cgroup1.yml'
-        run_shell_command(f'docker-compose {dcflags} up --scale hosts={hosts} -d')
+        dc = docker_compose(Config.get('compose_parallelism'))
+        # images were checked above, don't let compose look them up in the registry
+        pull = '--pull never' if docker_compose_supports('--pull', 'up') else ''
+        run_shell_command(f'{dc} {dcflags} up {pull} --scale hosts={hosts} -d')
+        invalidate_boxes_container_info()
 
-        run_shell_command('sudo sysctl net.ipv4.conf.all.forwarding=1')
-        run_shell_command('sudo iptables -P FORWARD ACCEPT')
+        run_shell_command(
+            "sudo sh -c 'sysctl -w net.ipv4.conf.all.forwarding=1 && iptables -P FORWARD ACCEPT'"
+        )
 
         print('Seting up host ssh servers')
-        for h in range(hosts):
-            host._setup_ssh(h + 1)
+        # each setup execs into a different container, run them concurrently
+        workers = max(1, min(hosts, Config.get('ssh_parallelism')))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(host._setup_ssh, range(1, hosts + 1)))
 
         verbose = '-v' if Config.get('verbose') else ''
         skip_deploy = '--skip-deploy-osds' if Config.get('skip-deploy-osds') else ''
@@ -219,28 +315,32 @@ class Cluster(Target):
             f'{skip_dashboard} '
             f'{skip_monitoring_stack} '
         )
-        run_dc_shell_command(box_bootstrap_command, 1, 'seed')
-
-        info = get_boxes_container_info()
-        ips = info['ips']
-        hostnames = info['hostnames']
-        print(ips)
-        host._copy_cluster_ssh_key(ips)
-
-        expanded = Config.get('expanded')
-        if expanded:
-            host._add_hosts(ips, hostnames)
-
-        if expanded and not Config.get('skip-deploy-osds'):
-            print('Deploying osds... This could take up to minutes')
-            osd.deploy_osds_in_vg('vg1')
-            print('Osds deployed')
+        # the remaining steps run in the seed one after another, share one exec
+        with SeedShell():
+            run_dc_shell_command(box_bootstrap_command, 1, 'seed')
+
+            info = get_boxes_container_info()
+            ips = info['ips']
+            hostnames = info['hostnames']
+            if Config.get('verbose'):
+                print(ips)
+            host._copy_cluster_ssh_key(ips)
+
+            expanded = Config.get('expanded')
+            if expanded:
+                host._add_hosts(ips, hostnames)
+
+            if expanded and not Config.get('skip-deploy-osds'):
+                print('Deploying osds... This could take up to minutes')
+                osd.deploy_osds_in_vg('vg1')
+                print('Osds deployed')
 
         print('Bootstrap finished successfully')
 
     @ensure_outside_container
     def down(self):
-        run_shell_command('docker-compose down')
+        run_shell_command(f'{docker_compose()} down')
+        invalidate_boxes_container_info()
         cleanup_box()
         print('Successfully killed all boxes')
 
@@ -258,7 +358,7 @@ class Cluster(Target):
         # we need verbose to see the prompt after running shell command
         Config.set('verbose', True)
         print('Seed bash')
-        run_shell_command('docker-compose exec seed bash')
+        run_shell_command(f'{docker_compose()} exec seed bash')
 
 
 targets = {
@@ -275,22 +375,15 @@ def main():
     )
 
     subparsers = parser.add_subparsers()
-    target_instances = {}
-    for name, target in targets.items():
-        target_instances[name] = target(None, subparsers)
-
-    for count, arg in enumerate(sys.argv, 1):
-        if arg in targets:
-            instance = target_instances[arg]
-            if hasattr(instance, 'main'):
-                instance.argv = sys.argv[count:]
-                instance.set_args()
-                args = parser.parse_args()
-                Config.add_args(vars(args))
-                instance.main()
-                sys.exit(0)
-
-    parser.print_help()
+    for target in targets.values():
+        target.register(subparsers)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.print_help()
+        return
+    Config.add_args(vars(args))
+    args.func()
 
 
 if __name__ == '__main__':
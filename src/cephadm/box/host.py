@@ -1,7 +1,9 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Union
 
 from util import (
+    SSH_PARALLELISM,
     Config,
     Target,
     get_boxes_container_info,
@@ -41,7 +43,8 @@ def _add_hosts(ips: Union[List[str], str], hostnames: Union[List[str], str]):
     else:
         print('Redirecting to _add_hosts to container')
         verbose = '-v' if Config.get('verbose') else ''
-        print(ips)
+        if Config.get('verbose'):
+            print(ips)
         ips = ' '.join(ips)
         ips = f'{ips}'
         hostnames = ' '.join(hostnames)
@@ -56,24 +59,37 @@ def _add_hosts(ips: Union[List[str], str], hostnames: Union[List[str], str]):
 def _copy_cluster_ssh_key(ips: Union[List[str], str]):
     if inside_container():
         local_ip = run_shell_command('hostname -i')
-        for ip in ips:
-            if ip != local_ip:
-                run_shell_command(
-                    (
-                        'sshpass -p "root" ssh-copy-id -f '
-                        f'-o StrictHostKeyChecking=no -i /etc/ceph/ceph.pub "root@{ip}"'
-                    )
+
+        def copy_key(ip):
+            run_shell_command(
+                (
+                    'sshpass -p "root" ssh-copy-id -f '
+                    f'-o StrictHostKeyChecking=no -i /etc/ceph/ceph.pub "root@{ip}"'
                 )
+            )
+
+        remote_ips = [ip for ip in ips if ip != local_ip]
+        if remote_ips:
+            # record the host keys once, so the concurrent ssh-copy-id calls below don't
+            # all write /root/.ssh/known_hosts at the same time
+            os.makedirs('/root/.ssh', mode=0o700, exist_ok=True)
+            run_shell_command(f'ssh-keyscan {" ".join(remote_ips)} >> /root/.ssh/known_hosts')
+            workers = max(1, min(len(remote_ips), Config.get('ssh_parallelism')))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(copy_key, remote_ips))
 
     else:
         print('Redirecting to _copy_cluster_ssh to container')
         verbose = '-v' if Config.get('verbose') else ''
-        print(ips)
+        if Config.get('verbose'):
+            print(ips)
         ips = ' '.join(ips)
         ips = f'{ips}'
         # assume we only have one seed
+        parallelism = Config.get('ssh_parallelism')
         run_dc_shell_command(
-            f'/cephadm/box/box.py {verbose} host copy_cluster_ssh_key 1 --ips {ips}',
+            f'/cephadm/box/box.py {verbose} host copy_cluster_ssh_key 1 --ips {ips} '
+            f'--ssh-parallelism {parallelism}',
             1,
             'seed',
         )
@@ -92,6 +108,12 @@ class Host(Target):
         self.parser.add_argument(
             '--hostnames', nargs='*', help='List of hostnames ips(relative to ip list)'
         )
+        self.parser.add_argument(
+            '--ssh-parallelism',
+            type=int,
+            default=SSH_PARALLELISM,
+            help='max number of hosts to copy the cluster ssh key to concurrently',
+        )
 
     def setup_ssh(self):
         _setup_ssh(Config.get('host_container_index'))
@@ -58,8 +58,8 @@ def create_loopback_devices(osds: int) -> None:
     run_shell_command(f'sudo vgcreate vg1 {avail_loop}')
 
     p = int(100 / osds)
+    run_shell_command('sudo vgchange --refresh')
     for i in range(osds):
-        run_shell_command('sudo vgchange --refresh')
         run_shell_command(f'sudo lvcreate -l {p}%VG --name lv{i} vg1')
 
 
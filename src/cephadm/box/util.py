@@ -1,3 +1,5 @@
+import copy
+import functools
 import json
 import os
 import subprocess
@@ -5,6 +7,10 @@ import sys
 from typing import Any, Callable, Dict
 
 
+# default max number of hosts ssh is set up on concurrently
+SSH_PARALLELISM = 16
+
+
 class Config:
     args = {
         'fsid': '00000000-0000-0000-0000-0000deadbeef',
@@ -30,12 +36,21 @@ class Config:
 
 
 class Target:
-    def __init__(self, argv, subparsers):
-        self.argv = argv
+    def __init__(self, subparsers):
         self.parser = subparsers.add_parser(
             self.__class__.__name__.lower(), help=self.__class__._help
         )
 
+    @classmethod
+    def register(cls, subparsers) -> 'Target':
+        """
+        Add the target's subcommand so it is dispatched to main when selected
+        """
+        target = cls(subparsers)
+        target.set_args()
+        target.parser.set_defaults(func=target.main)
+        return target
+
     def set_args(self):
         """
         adding the required arguments of the target should go here, example:
@@ -45,12 +60,10 @@ class Target:
 
     def main(self):
         """
-        A target will be setup by first calling this main function
-        where the parser is initialized.
+        A target will be run by calling this main function once the
+        arguments are parsed and added to Config.
         """
-        args = self.parser.parse_args(self.argv)
-        Config.add_args(vars(args))
-        function = getattr(self, args.action)
+        function = getattr(self, Config.get('action'))
         function()
 
 
@@ -74,11 +87,14 @@ def ensure_inside_container(func) -> bool:
     return wrapper
 
 
-def run_shell_command(command: str, expect_error=False) -> str:
+def run_shell_command(command: str, expect_error=False, merge_stderr=False) -> str:
     if Config.get('verbose'):
         print(f'Running command: {command}')
     process = subprocess.Popen(
-        command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        command,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT if merge_stderr else subprocess.PIPE,
     )
 
     out = ''
@@ -96,9 +112,12 @@ def run_shell_command(command: str, expect_error=False) -> str:
     process.wait()
 
     # no last break line
-    err = (
-        process.stderr.read().decode().rstrip()
-    )  # remove trailing whitespaces and new lines
+    if merge_stderr:
+        err = out.rstrip()
+    else:
+        err = (
+            process.stderr.read().decode().rstrip()
+        )  # remove trailing whitespaces and new lines
     out = out.strip()
 
     if process.returncode != 0 and not expect_error:
@@ -120,11 +139,112 @@ def run_cephadm_shell_command(command: str, expect_error=False) -> str:
     return out
 
 
+@functools.lru_cache(maxsize=1)
+def docker_compose_v2() -> bool:
+    process = subprocess.run(
+        ['docker', 'compose', 'version'],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return process.returncode == 0
+
+
+@functools.lru_cache(maxsize=None)
+def _docker_compose_help(subcommand: str) -> str:
+    process = subprocess.run(
+        ['docker', 'compose'] + subcommand.split() + ['--help'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    return process.stdout.decode()
+
+
+def docker_compose_supports(option: str, subcommand: str = '') -> bool:
+    """
+    Whether compose v2 lists option in the help of subcommand (or of compose
+    itself); older v2 releases reject options they don't know.
+    """
+    return docker_compose_v2() and option in _docker_compose_help(subcommand).split()
+
+
+def docker_compose(parallelism: int = 0) -> str:
+    """
+    Prefer compose v2, which runs operations in parallel, and fall back to
+    docker-compose v1. --compatibility keeps v1 container names (box_hosts_1)
+    which get_boxes_container_info relies on.
+    """
+    if not docker_compose_v2():
+        return 'docker-compose'
+    command = 'docker compose --compatibility'
+    if parallelism and docker_compose_supports('--parallel'):
+        command += f' --parallel {parallelism}'
+    return command
+
+
+class SeedShell:
+    """
+    Long running bash session inside the seed, so chained commands don't pay
+    the docker exec cost each time. While it is open, run_dc_shell_command
+    sends the seed commands through it, example:
+
+    with SeedShell():
+        run_dc_shell_command('box.py ...', 1, 'seed')
+    """
+
+    _current = None
+    _sentinel = '__BOX_SEED_SHELL_DONE__'
+
+    def __enter__(self):
+        self.process = subprocess.Popen(
+            f'{docker_compose()} exec -T seed bash',
+            shell=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        SeedShell._current = self
+        return self
+
+    def __exit__(self, *exc):
+        SeedShell._current = None
+        self.process.stdin.close()
+        self.process.wait()
+
+    def run(self, command: str, expect_error=False) -> str:
+        if Config.get('verbose'):
+            print(f'Running command in seed shell: {command}')
+        # commands must not read the session's stdin, it carries the next commands
+        self.process.stdin.write(
+            f'{{ {command}; }} < /dev/null; printf "\\n%s %s\\n" {self._sentinel} $?\n'.encode()
+        )
+        self.process.stdin.flush()
+
+        out = ''
+        while True:
+            line = self.process.stdout.readline().decode('latin1')
+            if not line:
+                raise RuntimeError(f'Seed shell exited while running: {command}')
+            if line.startswith(self._sentinel):
+                returncode = int(line.split()[1])
+                break
+            if Config.get('verbose'):
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            out += line
+        out = out.strip()
+
+        if returncode != 0 and not expect_error:
+            raise RuntimeError(f'Failed command: {command}\n{out}')
+        return out
+
+
 def run_dc_shell_command(
     command: str, index: int, box_type: str, expect_error=False
 ) -> str:
+    if SeedShell._current and box_type == 'seed' and index == 1:
+        return SeedShell._current.run(command, expect_error)
     out = run_shell_command(
-        f'docker-compose exec --index={index} {box_type} {command}', expect_error
+        f'{docker_compose()} exec --index={index} {box_type} {command}', expect_error
     )
     return out
 
@@ -133,29 +253,52 @@ def inside_container() -> bool:
     return os.path.exists('/.dockerenv')
 
 
-@ensure_outside_container
-def get_boxes_container_info(with_seed: bool = False) -> Dict[str, Any]:
-    # NOTE: this could be cached
-    IP = 0
-    CONTAINER_NAME = 1
-    HOSTNAME = 2
-    ips_query = "docker inspect -f '{{range .NetworkSettings.Networks}}{{.IPAddress}}{{end}} %tab% {{.Name}} %tab% {{.Config.Hostname}}' $(docker ps -aq) | sed 's#%tab%#\t#g' | sed 's#/##g' | sort -t . -k 1,1n -k 2,2n -k 3,3n -k 4,4n"
-    out = run_shell_command(ips_query)
+@functools.lru_cache(maxsize=2)
+def _get_boxes_container_info(with_seed: bool) -> Dict[str, Any]:
+    # compose names the project after the directory holding docker-compose.yml
+    ids = run_shell_command(
+        'docker ps -aq --filter label=com.docker.compose.project=box'
+    ).split()
+    containers = []
+    if ids:
+        # one inspect call for all the boxes
+        containers = json.loads(run_shell_command(f'docker inspect {" ".join(ids)}'))
     # FIXME: if things get more complex a class representing a container info might be useful,
     # for now representing data this way is faster.
     info = {'size': 0, 'ips': [], 'container_names': [], 'hostnames': []}
-    for line in out.split('\n'):
-        container = line.split()
-        # Most commands use hosts only
-        name_filter = 'box_' if with_seed else 'box_hosts'
-        if container[1].strip()[: len(name_filter)] == name_filter:
-            info['size'] += 1
-            info['ips'].append(container[IP])
-            info['container_names'].append(container[CONTAINER_NAME])
-            info['hostnames'].append(container[HOSTNAME])
+    boxes = []
+    # Most commands use hosts only
+    name_filter = 'box_' if with_seed else 'box_hosts'
+    for container in containers:
+        name = container['Name'].lstrip('/')
+        if not name.startswith(name_filter):
+            continue
+        ip = ''.join(
+            network['IPAddress']
+            for network in container['NetworkSettings']['Networks'].values()
+        )
+        boxes.append((ip, name, container['Config']['Hostname']))
+    # sort by ip, numerically per octet
+    boxes.sort(key=lambda box: [int(octet) for octet in box[0].split('.') if octet.isdigit()])
+    for ip, name, hostname in boxes:
+        info['size'] += 1
+        info['ips'].append(ip)
+        info['container_names'].append(name)
+        info['hostnames'].append(hostname)
     return info
 
 
+@ensure_outside_container
+def get_boxes_container_info(with_seed: bool = False) -> Dict[str, Any]:
+    # the boxes only change when they are started or stopped, which calls
+    # invalidate_boxes_container_info
+    return copy.deepcopy(_get_boxes_container_info(with_seed))
+
+
+def invalidate_boxes_container_info() -> None:
+    _get_boxes_container_info.cache_clear()
+
+
 def get_orch_hosts():
     orch_host_ls_out = run_cephadm_shell_command('ceph orch host ls --format json')
     hosts = json.loads(orch_host_ls_out)